@@ -1,6 +1,10 @@
 import argparse
 import csv
+import hashlib
+import heapq
 import json
+import os
+import tempfile
 
 from normalizer import Normalizer
 
@@ -29,21 +33,155 @@ def to_int(s):
         raise ValueError("cannot convert to int")
 
 
+# batch mode keeps at most this many distinct (section, row) pairs in memory
+DEFAULT_MAX_DISTINCT = 1000000
+# number of on-disk partitions used once the distinct pairs exceed the budget
+DEFAULT_PARTITIONS = 64
+
+
+def to_sample(row):
+    return {
+        "input": {"section": row["section"], "row": row["row"]},
+        "expected": {
+            "section_id": to_int(row["n_section_id"]),
+            "row_id": to_int(row["n_row_id"]),
+            "valid": to_bool(row["valid"]),
+        },
+    }
+
+
 def read_input(input_path):
-    samples = []
-    with open(input_path, "rU") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            sample = {
-                "input": {"section": row["section"], "row": row["row"]},
-                "expected": {
-                    "section_id": to_int(row["n_section_id"]),
-                    "row_id": to_int(row["n_row_id"]),
-                    "valid": to_bool(row["valid"]),
-                },
-            }
-            samples.append(sample)
-    return samples
+    return list(iter_input(input_path))
+
+
+def iter_input(input_path):
+    """streams samples from the input file one row at a time"""
+    with open(input_path, "r", newline="") as f:
+        for row in csv.DictReader(f):
+            yield to_sample(row)
+
+
+def normalize_file(normalizer, input_path, max_distinct=DEFAULT_MAX_DISTINCT, partitions=DEFAULT_PARTITIONS,
+                   tmp_dir=None):
+    """normalizes every distinct (section, row) pair of an input file once, yielding matches in input order
+
+    If the file has at most max_distinct distinct pairs they are deduplicated in memory.
+    Otherwise every row is spilled to one of `partitions` files on disk by a hash of its
+    pair, each partition is deduplicated and normalized on its own (partitions that still
+    have more than max_distinct distinct pairs are split again), and the per-partition
+    results are merged back into input order. At most max_distinct distinct pairs are held
+    in memory at a time.
+
+    Arguments:
+        normalizer {[Normalizer]} -- normalizer with a manifest loaded
+        input_path {[str]} -- /path/to/input
+        max_distinct {[int]} -- number of distinct pairs to keep in memory before spilling
+        partitions {[int]} -- number of partitions to spill to
+        tmp_dir {[str]} -- directory for spill files, defaults to the system temp directory
+    """
+    if max_distinct < 1:
+        raise ValueError("max_distinct must be at least 1")
+    if partitions < 2:
+        raise ValueError("partitions must be at least 2")
+
+    outputs = {}
+    for sample in iter_input(input_path):
+        key = (sample["input"]["section"], sample["input"]["row"])
+        if key not in outputs:
+            if len(outputs) >= max_distinct:
+                break
+            outputs[key] = None
+    else:
+        for key in outputs:
+            outputs[key] = normalizer.normalize(*key)
+        for sample in iter_input(input_path):
+            sid, rid, valid = outputs[(sample["input"]["section"], sample["input"]["row"])]
+            sample["output"] = {"section_id": sid, "row_id": rid, "valid": valid}
+            yield sample
+        return
+
+    outputs.clear()
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as spill_dir:
+        spilled = ((seq, sample["input"]["section"], sample["input"]["row"])
+                   for seq, sample in enumerate(iter_input(input_path)))
+        spill_paths = spill_partitions(spilled, os.path.join(spill_dir, "p"), partitions, level=0)
+        result_path = os.path.join(spill_dir, "results")
+        merge_results([normalize_partition(normalizer, path, max_distinct, partitions, level=0)
+                       for path in spill_paths], result_path)
+
+        with open(result_path, "r") as f:
+            for sample, (_, sid, rid, valid) in zip(iter_input(input_path), map(json.loads, f)):
+                sample["output"] = {"section_id": sid, "row_id": rid, "valid": valid}
+                yield sample
+
+
+def partition_of(section, row, level, partitions):
+    """hashes a (section, row) pair to a partition, salted by level so a re-split partition spreads out"""
+    digest = hashlib.blake2b(f"{section}\0{row}".encode("utf-8"), digest_size=8, salt=str(level).encode("utf-8"))
+    return int.from_bytes(digest.digest(), "little") % partitions
+
+
+def spill_partitions(spilled, path_prefix, partitions, level):
+    """writes (seq, section, row) entries to `partitions` spill files by hash, returning the spill file paths"""
+    spill_paths = [f"{path_prefix}.{i}" for i in range(partitions)]
+    spill_files = [open(path, "w") for path in spill_paths]
+    try:
+        for seq, section, row in spilled:
+            spill_files[partition_of(section, row, level, partitions)].write(json.dumps([seq, section, row]) + "\n")
+    finally:
+        for f in spill_files:
+            f.close()
+    return spill_paths
+
+
+def read_spill(spill_path):
+    with open(spill_path, "r") as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def normalize_partition(normalizer, spill_path, max_distinct, partitions, level):
+    """normalizes the distinct pairs of a spill file, returning the path to its results sorted by seq
+
+    A spill file with more than max_distinct distinct pairs is split into `partitions`
+    smaller spill files which are normalized recursively and merged.
+    """
+    result_path = spill_path + ".out"
+    outputs = {}
+    for _, section, row in read_spill(spill_path):
+        if (section, row) not in outputs:
+            if len(outputs) >= max_distinct:
+                break
+            outputs[(section, row)] = None
+    else:
+        for key in outputs:
+            outputs[key] = normalizer.normalize(*key)
+        with open(result_path, "w") as f:
+            for seq, section, row in read_spill(spill_path):
+                f.write(json.dumps([seq, *outputs[(section, row)]]) + "\n")
+        os.remove(spill_path)
+        return result_path
+
+    outputs.clear()
+    sub_paths = spill_partitions(read_spill(spill_path), spill_path, partitions, level + 1)
+    os.remove(spill_path)
+    merge_results([normalize_partition(normalizer, path, max_distinct, partitions, level + 1) for path in sub_paths],
+                  result_path)
+    return result_path
+
+
+def merge_results(result_paths, merged_path):
+    """merges result files that are each sorted by seq into one sorted file, removing the inputs"""
+    result_files = [open(path, "r") for path in result_paths]
+    try:
+        with open(merged_path, "w") as f:
+            for line in heapq.merge(*result_files, key=lambda line: json.loads(line)[0]):
+                f.write(line)
+    finally:
+        for f in result_files:
+            f.close()
+    for path in result_paths:
+        os.remove(path)
 
 
 def normalize_samples(normalizer, samples, verbose=False):
@@ -55,6 +193,34 @@ def normalize_samples(normalizer, samples, verbose=False):
     return matched
 
 
+def read_results(results_path):
+    """streams matches from a previous output file, skipping any lines that are not json"""
+    with open(results_path, "r") as f:
+        for line in f:
+            if line.lstrip().startswith("{"):
+                yield json.loads(line)
+
+
+def renormalize_results(normalizer, old_normalizer, results_path):
+    """re-normalizes only the previous matches a manifest change could affect, carrying the rest forward
+
+    Arguments:
+        normalizer {[Normalizer]} -- normalizer with the new manifest loaded
+        old_normalizer {[Normalizer]} -- normalizer with the manifest the results were produced with
+        results_path {[str]} -- /path/to/previous/output
+    """
+    changes = normalizer.diff_manifest(old_normalizer)
+    outputs = {}
+    for match in read_results(results_path):
+        key = (match["input"]["section"], match["input"]["row"])
+        if normalizer.may_change(changes, *key):
+            if key not in outputs:
+                outputs[key] = normalizer.normalize(*key)
+            sid, rid, valid = outputs[key]
+            match["output"] = {"section_id": sid, "row_id": rid, "valid": valid}
+        yield match
+
+
 def output_samples(matched):
     """The grading script will print this to the command line in json format"""
     for match in matched:
@@ -67,12 +233,25 @@ if __name__ == "__main__":
     parser.add_argument("--input", default=None, help="path to input file")
     parser.add_argument("--section", default=None, help="section input (for testing)")
     parser.add_argument("--row", default=None, help="row input (for testing)")
+    parser.add_argument("--batch", action="store_true", help="deduplicate input rows with bounded memory")
+    parser.add_argument("--max-distinct", type=int, default=DEFAULT_MAX_DISTINCT,
+                        help="distinct (section, row) pairs kept in memory before spilling to disk (batch mode)")
+    parser.add_argument("--partitions", type=int, default=DEFAULT_PARTITIONS,
+                        help="number of spill files to hash partition into (batch mode)")
+    parser.add_argument("--tmp-dir", default=None, help="directory for spill files (batch mode)")
+    parser.add_argument("--adaptive-rules", action="store_true",
+                        help="try the most productive section matching rules first")
+    parser.add_argument("--save-rule-stats", action="store_true",
+                        help="save section matching rule stats next to the manifest for later runs")
+    parser.add_argument("--previous", default=None,
+                        help="path to a previous output file to update for a changed manifest")
+    parser.add_argument("--old-manifest", default=None, help="path to the manifest the previous output used")
 
     args = parser.parse_args()
 
     assert args.manifest
 
-    normalizer = Normalizer()
+    normalizer = Normalizer(adaptive_rules=args.adaptive_rules)
     normalizer.read_manifest(args.manifest)
 
     if args.section and args.row:
@@ -88,7 +267,22 @@ if __name__ == "__main__":
         """
         )
 
+    elif args.previous:
+        assert args.old_manifest
+        old_normalizer = Normalizer()
+        old_normalizer.read_manifest(args.old_manifest)
+        matched = renormalize_results(normalizer, old_normalizer, args.previous)
+        output_samples(matched)
+
+    elif args.input and args.batch:
+        matched = normalize_file(normalizer, args.input, max_distinct=args.max_distinct,
+                                 partitions=args.partitions, tmp_dir=args.tmp_dir)
+        output_samples(matched)
+
     elif args.input:
         samples = read_input(args.input)
         matched = normalize_samples(normalizer, samples, verbose=False)
         output_samples(matched)
+
+    if args.save_rule_stats:
+        normalizer.save_rule_stats()
@@ -1,12 +1,29 @@
 import csv
-from operator import itemgetter
+import json
+import os
+from bisect import bisect_left, bisect_right
 from difflib import SequenceMatcher
+from collections import Counter
 from itertools import chain, combinations
+from multiprocessing import shared_memory
+
+from shared_manifest import SharedManifest, attach_shared_memory, pack_manifest, unlink_shared_memory
 
 
 class Normalizer(object):
-    def __init__(self):
+    def __init__(self, adaptive_rules=False):
+        """
+        Arguments:
+            adaptive_rules {[bool]} -- try the section matching rules that produced the most matches first
+        """
         self.manifest_dict = {}
+        self._shm = None
+        self._row_index = {}
+        self.adaptive_rules = adaptive_rules
+        self.rule_stats = Counter()
+        self.rule_order = list(SECTION_RULES)
+        self.rule_stats_path = None
+        self._rule_matches = 0
 
     def read_manifest(self, manifest):
         """reads a manifest file
@@ -21,7 +38,9 @@ class Normalizer(object):
             manifest {[str]} -- /path/to/manifest
         """
 
-        self.manifest_dict.clear()
+        self.close_manifest()
+        self.manifest_dict = {}
+        self.load_rule_stats(rule_stats_path(manifest))
 
         with open(manifest, 'r') as f:
             csv_reader = csv.reader(f, delimiter=',')
@@ -58,6 +77,103 @@ class Normalizer(object):
                     else:
                         raise ValueError('Invalid CSV file format.')
 
+    def freeze_manifest(self):
+        """packs the loaded manifest into a single read-only buffer
+
+        Call this in a parent process before forking workers: the packed buffer is one
+        object, so reads from the workers do not dirty the copy-on-write pages the way
+        touching every key and value of a nested dict does.
+        """
+        self.manifest_dict = SharedManifest(pack_manifest(self.manifest_dict))
+
+    def share_manifest(self, name=None):
+        """packs the loaded manifest into a named shared memory block
+
+        Returns the block name, which worker processes pass to attach_manifest. The
+        calling process owns the block and must call close_manifest(unlink=True) once
+        the workers are done with it.
+
+        Arguments:
+            name {[str]} -- optional name for the shared memory block
+        """
+        data = pack_manifest(self.manifest_dict)
+        self.close_manifest()
+        shm = shared_memory.SharedMemory(name=name, create=True, size=len(data))
+        shm.buf[:len(data)] = data
+        self._shm = shm
+        self.manifest_dict = SharedManifest(shm.buf)
+        return shm.name
+
+    def attach_manifest(self, name):
+        """queries a manifest previously published with share_manifest instead of reading a CSV
+
+        Arguments:
+            name {[str]} -- name of the shared memory block
+        """
+        self.close_manifest()
+        self._shm = attach_shared_memory(name)
+        self.manifest_dict = SharedManifest(self._shm.buf)
+
+    def close_manifest(self, unlink=False):
+        """detaches from a shared manifest, unlinking the block if unlink is set"""
+        self._row_index.clear()
+        if isinstance(self.manifest_dict, SharedManifest):
+            self.manifest_dict.release()
+            self.manifest_dict = {}
+        if self._shm:
+            self._shm.close()
+            if unlink:
+                unlink_shared_memory(self._shm)
+            self._shm = None
+
+    def load_rule_stats(self, path):
+        """resets the section matching rule stats, loading any stats previously saved to path"""
+        self.rule_stats = Counter()
+        self.rule_stats_path = path
+        self._rule_matches = 0
+        if path and os.path.exists(path):
+            with open(path, 'r') as f:
+                saved = json.load(f)
+            self.rule_stats.update({rule: count for rule, count in saved.items() if rule in SECTION_RULES})
+        self.update_rule_order()
+
+    def save_rule_stats(self, path=None):
+        """saves the section matching rule stats, by default next to the loaded manifest"""
+        path = path or self.rule_stats_path
+        if not path:
+            raise ValueError('No path to save rule stats to.')
+        with open(path, 'w') as f:
+            json.dump(dict(self.rule_stats), f, indent=2, sort_keys=True)
+
+    def record_rule_match(self, features1, features2, strict=False):
+        """samples which section matching rules match a pair of matching sections
+
+        Every RULE_STATS_SAMPLE_INTERVAL-th match, every rule is evaluated and each one that
+        matches is counted, so the stats do not depend on the order the rules are tried in.
+        The rules are re-ordered after each sample if adaptive.
+        """
+        self._rule_matches += 1
+        if self._rule_matches % RULE_STATS_SAMPLE_INTERVAL:
+            return
+
+        for rule, match in SECTION_RULES.items():
+            if match(features1, features2, strict=strict):
+                self.rule_stats[rule] += 1
+        if self.adaptive_rules:
+            self.update_rule_order()
+
+    def update_rule_order(self):
+        """orders the section matching rules by matches per unit of cost if adaptive
+
+        digits_only is nearly free so it always goes first, and ties keep the default order.
+        Every rule is a pure check and sections_equal returns as soon as any rule matches,
+        so the order only changes how much work a comparison takes, never its result.
+        """
+        self.rule_order = list(SECTION_RULES)
+        if self.adaptive_rules:
+            self.rule_order[1:] = sorted(self.rule_order[1:],
+                                         key=lambda rule: -self.rule_stats[rule] / RULE_COSTS[rule])
+
     def normalize(self, section, row):
         """normalize a single (section, row) input
 
@@ -102,6 +218,134 @@ class Normalizer(object):
 
         return None, None, False
 
+    def normalize_range(self, section, row):
+        """normalize a ranged (section, row) input such as (133, A-F) or (Pavilion 314, 1-10)
+
+        Given a (Section, Row) input where row is a range, returns (section_id, row_ids, valid)
+        where
+            section_id = int or None
+            row_ids = list of int, in row order (empty if invalid)
+            valid = True or False
+
+        Arguments:
+            section {[str]} -- [section name]
+            row {[str]} -- [ranged row name]
+        """
+        bounds = self.parse_row_range(row)
+        if not bounds:
+            return None, [], False
+
+        existing_section = self.query_section(section)
+        if existing_section:
+            section_id = self.manifest_dict[existing_section]['section_id']
+            keys, row_ids = self.query_row_index(existing_section)
+            start = bisect_left(keys, bounds[0])
+            end = bisect_right(keys, bounds[1])
+            if start < end:
+                return section_id, row_ids[start:end], True
+
+        return None, [], False
+
+    def parse_row_range(self, row):
+        """parses a ranged row into (low, high) row sort keys
+
+        Both ends of the range are normalized like any other row and must be of the same
+        kind (numeric, or one/two letters). Returns None if the row is not a usable range.
+
+        Arguments:
+            row {[str]} -- [ranged row name]
+        """
+        if not row or row.count('-') != 1:
+            return None
+
+        low, high = (self.row_sort_key(self.normalize_row(end)) for end in row.split('-'))
+        if not low or not high or low[0] != high[0] or low > high:
+            return None
+        return low, high
+
+    def query_row_index(self, section):
+        """returns the ordered row index of a section as parallel lists of (row sort keys, row ids)
+
+        The index is built the first time a section is queried and cached until a new
+        manifest is loaded. Rows that are neither numeric nor one/two letters are left out.
+        """
+        if section not in self._row_index:
+            rows = self.manifest_dict[section]['rows'] or {}
+            index = sorted(
+                (key, row_id) for key, row_id in ((self.row_sort_key(name), row_id) for name, row_id in rows.items())
+                if key)
+            self._row_index[section] = [key for key, _ in index], [row_id for _, row_id in index]
+        return self._row_index[section]
+
+    @staticmethod
+    def row_sort_key(n_row):
+        """returns a sort key for a normalized row, or None if it can not be ordered
+
+        Numeric rows sort by value, letter rows sort like A-Z followed by AA-ZZ.
+        """
+        if n_row.isdecimal():
+            return 0, int(n_row), ''
+        elif 0 < len(n_row) <= 2 and n_row.isalpha():
+            return 1, len(n_row), n_row
+        return None
+
+    def digit_bucket(self, section_name):
+        """returns the digits sections_equal compares, so sections can only match within the same bucket"""
+        return self.extract_section_features(section_name)['digits'].lstrip('0')
+
+    def diff_manifest(self, old):
+        """compares the loaded manifest against a previously loaded one
+
+        Given an (old) normalizer, returns (changes)
+        where
+            (changes) = dict containing:
+                * sections {[set]} - [section names added, removed, or with a changed section id or rows]
+                * rows {[set]} - [(section name, normalized row name) pairs added, removed, or with a changed row id]
+                * digit_buckets {[set]} - [digit buckets whose ordered sections differ]
+
+        Arguments:
+            old {[Normalizer]} -- normalizer with the previous manifest loaded
+        """
+        changes = {'sections': set(), 'rows': set(), 'digit_buckets': set()}
+        buckets = ({}, {})
+
+        for manifest_dict, manifest_buckets in zip((old.manifest_dict, self.manifest_dict), buckets):
+            for section in manifest_dict:
+                section_data = manifest_dict[section]
+                entry = (section, section_data['section_id'], dict(section_data['rows'] or {}))
+                manifest_buckets.setdefault(self.digit_bucket(section), []).append(entry)
+
+        old_sections = {entry[0]: entry for bucket in buckets[0].values() for entry in bucket}
+        new_sections = {entry[0]: entry for bucket in buckets[1].values() for entry in bucket}
+        for section in old_sections.keys() | new_sections.keys():
+            _, old_id, old_rows = old_sections.get(section, (section, None, {}))
+            _, new_id, new_rows = new_sections.get(section, (section, None, {}))
+            changed_rows = {(section, row) for row in old_rows.keys() | new_rows.keys()
+                            if old_rows.get(row) != new_rows.get(row)}
+            if section not in old_sections or section not in new_sections or old_id != new_id or changed_rows:
+                changes['sections'].add(section)
+            changes['rows'].update(changed_rows)
+
+        for bucket in buckets[0].keys() | buckets[1].keys():
+            if buckets[0].get(bucket) != buckets[1].get(bucket):
+                changes['digit_buckets'].add(bucket)
+
+        return changes
+
+    def may_change(self, changes, section, row):
+        """determines if a manifest change (see diff_manifest) could change the result of normalize(section, row)
+
+        Suite sections are looked up by name, ranged rows are always invalid, and any
+        other section can only match a manifest section in its own digit bucket.
+        """
+        if not row:
+            return self.normalize_suite(section) in changes['sections']
+
+        if '-' in row:
+            return False
+
+        return self.digit_bucket(section.strip().lower()) in changes['digit_buckets']
+
     def query_section(self, section_name, strict=False):
         """queries for an existing section given an non-normalized section name
 
@@ -136,41 +380,15 @@ class Normalizer(object):
         if s1 == s2:
             return True
 
-        dict_attrs = (
-            'preceding_phrase',
-            'prefix',
-            'digits',
-            'suffix',
-            'following_phrase',)
-
         features1 = self.extract_section_features(s1)
-        preceding_phrase1, prefix1, digits1, suffix1, following_phrase1 = itemgetter(*dict_attrs)(features1)
         features2 = self.extract_section_features(s2)
-        preceding_phrase2, prefix2, digits2, suffix2, following_phrase2 = itemgetter(*dict_attrs)(features2)
 
         # first check that extracted digits matches unless comparing suites
-        if digits1.lstrip('0') == digits2.lstrip('0'):
-
-            # if one of the sections only feature is the digits return true
-            if (not preceding_phrase1 and not prefix1 and not suffix1 and not following_phrase1) or \
-                    (not preceding_phrase2 and not prefix2 and not suffix2 and not following_phrase2):
-                return True
-
-            for phrase1 in [preceding_phrase1, following_phrase1]:
-                for phrase2 in [preceding_phrase2, following_phrase2]:
-                    if phrase1 and phrase2 and phrases_equal(phrase1, phrase2, strict=strict):
-                        return True
-                for abr2 in [prefix2, suffix2]:
-                    if phrase1 and abr2 and phrase_equals_abbreviation(phrase1, abr2, strict=strict):
-                        return True
-
-            for abr1 in [prefix1, suffix1]:
-                for phrase2 in [preceding_phrase2, following_phrase2]:
-                    if abr1 and phrase2 and phrase_equals_abbreviation(phrase2, abr1, strict=strict):
-                        return True
-                for abr2 in [prefix2, suffix2]:
-                    if abr1 and abr2 and abbreviations_equal(abr1, abr2):
-                        return True
+        if features1['digits'].lstrip('0') == features2['digits'].lstrip('0'):
+            for rule in self.rule_order:
+                if SECTION_RULES[rule](features1, features2, strict=strict):
+                    self.record_rule_match(features1, features2, strict=strict)
+                    return True
         return False
 
     def extract_section_features(self, section):
@@ -297,6 +515,68 @@ class Normalizer(object):
         return self.normalize_row(row1) == self.normalize_row(row2)
 
 
+def rule_stats_path(manifest):
+    """returns the path section matching rule stats are saved to for a manifest"""
+    return os.path.splitext(manifest)[0] + '_rules.json'
+
+
+NON_DIGIT_FEATURES = ('preceding_phrase', 'prefix', 'suffix', 'following_phrase')
+
+
+def digits_only_match(features1, features2, strict=False):
+    """matches when one of the sections only feature is its digits"""
+    return not any(features1[attr] for attr in NON_DIGIT_FEATURES) or \
+        not any(features2[attr] for attr in NON_DIGIT_FEATURES)
+
+
+def phrase_phrase_match(features1, features2, strict=False):
+    """matches when a preceding/following phrase of each section are equal"""
+    for phrase1 in [features1['preceding_phrase'], features1['following_phrase']]:
+        for phrase2 in [features2['preceding_phrase'], features2['following_phrase']]:
+            if phrase1 and phrase2 and phrases_equal(phrase1, phrase2, strict=strict):
+                return True
+    return False
+
+
+def phrase_abbreviation_match(features1, features2, strict=False):
+    """matches when a phrase of one section equals a prefix/suffix abbreviation of the other"""
+    for phrase_features, abr_features in [(features1, features2), (features2, features1)]:
+        for phrase in [phrase_features['preceding_phrase'], phrase_features['following_phrase']]:
+            for abr in [abr_features['prefix'], abr_features['suffix']]:
+                if phrase and abr and phrase_equals_abbreviation(phrase, abr, strict=strict):
+                    return True
+    return False
+
+
+def abbreviation_abbreviation_match(features1, features2, strict=False):
+    """matches when a prefix/suffix abbreviation of each section are equal"""
+    for abr1 in [features1['prefix'], features1['suffix']]:
+        for abr2 in [features2['prefix'], features2['suffix']]:
+            if abr1 and abr2 and abbreviations_equal(abr1, abr2):
+                return True
+    return False
+
+
+# section matching rules applied by Normalizer.sections_equal once the digits match, in default order
+SECTION_RULES = {
+    'digits_only': digits_only_match,
+    'phrase_phrase': phrase_phrase_match,
+    'phrase_abbreviation': phrase_abbreviation_match,
+    'abbreviation_abbreviation': abbreviation_abbreviation_match,
+}
+
+# rough relative cost of evaluating each rule, measured on the sample manifests
+RULE_COSTS = {
+    'digits_only': 1,
+    'phrase_phrase': 4,
+    'phrase_abbreviation': 6,
+    'abbreviation_abbreviation': 2,
+}
+
+# one in this many matching comparisons is sampled into Normalizer.rule_stats
+RULE_STATS_SAMPLE_INTERVAL = 8
+
+
 def generate_acronym(phrase):
     """returns the first letter in a series of words"""
     return ''.join(s[0].lower() for s in phrase.split())
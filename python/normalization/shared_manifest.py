@@ -0,0 +1,197 @@
+import struct
+import sys
+from collections.abc import Mapping
+from multiprocessing import resource_tracker, shared_memory
+
+# packed manifest layout (all little endian):
+#   header      -- magic, section count, total row count
+#   sections    -- (name offset, name length, section id, first row, row count or -1 when rows is None)
+#   rows        -- (name offset, name length, row id), stored contiguously per section
+#   section_idx -- section positions sorted by encoded name, used for lookups
+#   row_idx     -- per section row positions sorted by encoded name, used for lookups
+#   pool        -- utf-8 encoded section and row names
+MAGIC = b'SNM1'
+HEADER = struct.Struct('<4sII')
+SECTION = struct.Struct('<IIiIi')
+ROW = struct.Struct('<IIi')
+INDEX = struct.Struct('<I')
+
+
+def pack_manifest(manifest_dict):
+    """packs a manifest dict into a flat, read-only buffer
+
+    The section and row iteration order of manifest_dict is preserved so a
+    SharedManifest answers queries exactly like the dict it was packed from.
+
+    Arguments:
+        manifest_dict {[dict]} -- manifest dict built by Normalizer.read_manifest
+    """
+    pool = bytearray()
+
+    def intern(s):
+        encoded = s.encode('utf-8')
+        offset = len(pool)
+        pool.extend(encoded)
+        return offset, len(encoded), encoded
+
+    sections = []
+    rows = []
+    section_keys = []
+    row_idx = []
+    for section_name, section_data in manifest_dict.items():
+        name_off, name_len, encoded = intern(section_name)
+        section_keys.append(encoded)
+        section_rows = section_data.get('rows')
+        if section_rows is None:
+            sections.append((name_off, name_len, section_data['section_id'], len(rows), -1))
+            continue
+
+        first_row = len(rows)
+        row_keys = []
+        for row_name, row_id in section_rows.items():
+            row_off, row_len, row_encoded = intern(row_name)
+            rows.append((row_off, row_len, row_id))
+            row_keys.append(row_encoded)
+        row_idx.extend(sorted(range(len(row_keys)), key=row_keys.__getitem__))
+        sections.append((name_off, name_len, section_data['section_id'], first_row, len(row_keys)))
+
+    section_idx = sorted(range(len(section_keys)), key=section_keys.__getitem__)
+
+    buf = bytearray(HEADER.pack(MAGIC, len(sections), len(rows)))
+    for section in sections:
+        buf.extend(SECTION.pack(*section))
+    for row in rows:
+        buf.extend(ROW.pack(*row))
+    for i in section_idx:
+        buf.extend(INDEX.pack(i))
+    for i in row_idx:
+        buf.extend(INDEX.pack(i))
+    buf.extend(pool)
+    return bytes(buf)
+
+
+def attach_shared_memory(name):
+    """attaches to an existing shared memory block without taking ownership of it
+
+    Before python 3.13 attaching registers the block with this process's resource
+    tracker, which unlinks it as soon as this process exits, so it is unregistered again.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    shm = shared_memory.SharedMemory(name=name)
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+def unlink_shared_memory(shm):
+    """unlinks a shared memory block created by this process, ignoring a block that is already gone"""
+    if sys.version_info < (3, 13):
+        # a worker forked from this process shares its resource tracker and may have unregistered the block
+        resource_tracker.register(shm._name, 'shared_memory')
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+
+
+class SharedManifest(Mapping):
+    """read-only view of a packed manifest that behaves like Normalizer.manifest_dict
+
+    Nothing is unpacked up front: section data and rows are decoded from the
+    buffer on access, so the buffer can live in shared memory (or in pages
+    inherited over fork) without every process keeping its own copy.
+    """
+
+    def __init__(self, buf):
+        self._buf = memoryview(buf)
+        magic, self._section_count, self._row_count = HEADER.unpack_from(self._buf, 0)
+        if magic != MAGIC:
+            raise ValueError('Invalid packed manifest.')
+        self._sections_off = HEADER.size
+        self._rows_off = self._sections_off + SECTION.size * self._section_count
+        self._section_idx_off = self._rows_off + ROW.size * self._row_count
+        self._row_idx_off = self._section_idx_off + INDEX.size * self._section_count
+        self._pool_off = self._row_idx_off + INDEX.size * self._row_count
+
+    def release(self):
+        """releases the underlying buffer so a shared memory block can be closed"""
+        self._buf.release()
+
+    def _name(self, offset, length):
+        start = self._pool_off + offset
+        return bytes(self._buf[start:start + length])
+
+    def _section(self, i):
+        return SECTION.unpack_from(self._buf, self._sections_off + SECTION.size * i)
+
+    def _row(self, i):
+        return ROW.unpack_from(self._buf, self._rows_off + ROW.size * i)
+
+    def _index(self, offset, i):
+        return INDEX.unpack_from(self._buf, offset + INDEX.size * i)[0]
+
+    def _search(self, key, count, idx_off, entry):
+        """binary searches a sorted index for an encoded name, returning the unpacked entry or None"""
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            found = entry(self._index(idx_off, mid))
+            name = self._name(found[0], found[1])
+            if name < key:
+                lo = mid + 1
+            elif name > key:
+                hi = mid
+            else:
+                return found
+        return None
+
+    def _section_data(self, section):
+        _, _, section_id, first_row, row_count = section
+        rows = None if row_count < 0 else SharedRows(self, first_row, row_count)
+        return {'section_id': section_id, 'rows': rows}
+
+    def __getitem__(self, section_name):
+        if not isinstance(section_name, str):
+            raise KeyError(section_name)
+        section = self._search(section_name.encode('utf-8'), self._section_count, self._section_idx_off, self._section)
+        if section is None:
+            raise KeyError(section_name)
+        return self._section_data(section)
+
+    def __iter__(self):
+        for i in range(self._section_count):
+            name_off, name_len, _, _, _ = self._section(i)
+            yield self._name(name_off, name_len).decode('utf-8')
+
+    def __len__(self):
+        return self._section_count
+
+
+class SharedRows(Mapping):
+    """read-only view of a single section's rows inside a SharedManifest"""
+
+    def __init__(self, manifest, first_row, row_count):
+        self._manifest = manifest
+        self._first_row = first_row
+        self._row_count = row_count
+
+    def _row(self, i):
+        return self._manifest._row(self._first_row + i)
+
+    def __getitem__(self, row_name):
+        if not isinstance(row_name, str):
+            raise KeyError(row_name)
+        manifest = self._manifest
+        idx_off = manifest._row_idx_off + INDEX.size * self._first_row
+        row = manifest._search(row_name.encode('utf-8'), self._row_count, idx_off, self._row)
+        if row is None:
+            raise KeyError(row_name)
+        return row[2]
+
+    def __iter__(self):
+        for i in range(self._row_count):
+            name_off, name_len, _ = self._row(i)
+            yield self._manifest._name(name_off, name_len).decode('utf-8')
+
+    def __len__(self):
+        return self._row_count
@@ -1,7 +1,13 @@
-from normalizer import Normalizer, phrase_equals_abbreviation, phrases_equal
+from normalizer import Normalizer, phrase_equals_abbreviation, phrases_equal, RULE_STATS_SAMPLE_INTERVAL
 import unittest
 import json
-from normalize import read_input, normalize_samples
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from shared_manifest import attach_shared_memory, unlink_shared_memory
+from normalize import read_input, normalize_samples, iter_input, normalize_file, renormalize_results
 
 
 class TestNormalizer(unittest.TestCase):
@@ -41,6 +47,23 @@ class TestNormalizer(unittest.TestCase):
         self.assertEqual(normalizer.normalize_row('AA-XX	'), 'aa-xx')
         self.assertEqual(normalizer.normalize_row('1-10	'), '1-10')
 
+    def test_row_sort_key(self):
+        self.assertLess(Normalizer.row_sort_key('2'), Normalizer.row_sort_key('10'))
+        self.assertLess(Normalizer.row_sort_key('z'), Normalizer.row_sort_key('aa'))
+        self.assertIsNone(Normalizer.row_sort_key('awc'))
+        self.assertIsNone(Normalizer.row_sort_key(''))
+
+    def test_normalize_range(self):
+        normalizer = Normalizer()
+        normalizer.read_manifest('../../manifests/citifield_sections.csv')
+        self.assertEqual(normalizer.normalize_range('133', 'A-C'), (1, [0, 1, 2], True))
+        self.assertEqual(normalizer.normalize_range('133', 'A-Z'), (1, [0, 1, 2, 3, 4], True))
+        self.assertEqual(normalizer.normalize_range('Excelsior Level 315', 'Row 2-Row 4'), (80, [1, 2, 3], True))
+        self.assertEqual(normalizer.normalize_range('133', 'AA-XX'), (None, [], False))
+        self.assertEqual(normalizer.normalize_range('133', 'C-A'), (None, [], False))
+        self.assertEqual(normalizer.normalize_range('133', '1-C'), (None, [], False))
+        self.assertEqual(normalizer.normalize_range('133', 'C'), (None, [], False))
+
     def test_phrase_equals_abbreviation(self):
         self.assertTrue(phrase_equals_abbreviation('reserve', 'rs'))
         self.assertTrue(phrase_equals_abbreviation('left field pavilion', 'pl'))
@@ -49,6 +72,144 @@ class TestNormalizer(unittest.TestCase):
     def test_phrase_equal(self):
         self.assertTrue(phrases_equal('right field pavilion', 'pavilion'))
 
+    def test_shared_manifest(self):
+        normalizer = Normalizer()
+        normalizer.read_manifest('../../manifests/dodgerstadium_sections.csv')
+        manifest_dict = normalizer.manifest_dict
+        inputs = [('311PL', 'G'), ('41FD', 'K'), ('Pavilion 314', 'C'), ('Top Deck 6', 'A'), ('1000', 'A')]
+        expected = [normalizer.normalize(section, row) for section, row in inputs]
+
+        name = normalizer.share_manifest()
+        try:
+            worker = Normalizer()
+            worker.attach_manifest(name)
+            self.assertEqual(list(worker.manifest_dict), list(manifest_dict))
+            for section in manifest_dict:
+                section_data = worker.manifest_dict[section]
+                self.assertEqual(section_data['section_id'], manifest_dict[section]['section_id'])
+                self.assertEqual(dict(section_data['rows'] or {}), manifest_dict[section]['rows'] or {})
+            self.assertNotIn('not a section', worker.manifest_dict)
+            self.assertEqual([worker.normalize(section, row) for section, row in inputs], expected)
+            worker.close_manifest()
+        finally:
+            normalizer.close_manifest(unlink=True)
+
+    def test_shared_manifest_worker_exit(self):
+        normalizer = Normalizer()
+        normalizer.read_manifest('../../manifests/dodgerstadium_sections.csv')
+        expected = normalizer.normalize('311PL', 'G')
+        worker_script = (
+            'import sys\n'
+            'from normalizer import Normalizer\n'
+            'worker = Normalizer()\n'
+            'worker.attach_manifest(sys.argv[1])\n'
+            'print(worker.normalize("311PL", "G"))\n'
+            'worker.close_manifest()\n'
+        )
+
+        name = normalizer.share_manifest()
+        try:
+            for _ in range(2):
+                worker = subprocess.run(
+                    [sys.executable, '-c', worker_script, name],
+                    cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+                self.assertEqual(worker.returncode, 0, worker.stderr)
+                self.assertEqual(worker.stdout.strip(), str(expected))
+                self.assertNotIn('leaked', worker.stderr)
+
+            attached = Normalizer()
+            attached.attach_manifest(name)
+            self.assertEqual(attached.normalize('311PL', 'G'), expected)
+            attached.close_manifest()
+        finally:
+            normalizer.close_manifest(unlink=True)
+
+        # unlinking a block that is already gone is a no-op
+        name = normalizer.share_manifest()
+        shm = attach_shared_memory(name)
+        shm.close()
+        unlink_shared_memory(shm)
+        normalizer.close_manifest(unlink=True)
+
+    def test_normalize_file(self):
+        normalizer = Normalizer()
+        normalizer.read_manifest('../../manifests/citifield_sections.csv')
+        input = '../../samples/metstest.csv'
+        expected = []
+        for sample in iter_input(input):
+            sid, rid, valid = normalizer.normalize(sample['input']['section'], sample['input']['row'])
+            sample['output'] = {'section_id': sid, 'row_id': rid, 'valid': valid}
+            expected.append(sample)
+
+        self.assertEqual(list(normalize_file(normalizer, input)), expected)
+        self.assertEqual(list(normalize_file(normalizer, input, max_distinct=5, partitions=4)), expected)
+        # partitions with more than max_distinct distinct pairs are split again
+        self.assertEqual(list(normalize_file(normalizer, input, max_distinct=2, partitions=2)), expected)
+
+    def test_rule_stats(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            manifest = os.path.join(tmp_dir, 'dodgerstadium_sections.csv')
+            shutil.copy('../../manifests/dodgerstadium_sections.csv', manifest)
+
+            normalizer = Normalizer(adaptive_rules=True)
+            normalizer.read_manifest(manifest)
+            for _ in range(RULE_STATS_SAMPLE_INTERVAL):
+                self.assertEqual(normalizer.normalize('311PL', 'G'), (160, 6, True))
+            self.assertEqual(normalizer.rule_stats, {'phrase_abbreviation': 1})
+            self.assertEqual(normalizer.rule_order[:2], ['digits_only', 'phrase_abbreviation'])
+            normalizer.save_rule_stats()
+
+            warm = Normalizer(adaptive_rules=True)
+            warm.read_manifest(manifest)
+            self.assertEqual(warm.rule_stats, normalizer.rule_stats)
+            self.assertEqual(warm.rule_order, normalizer.rule_order)
+
+            default = Normalizer()
+            default.read_manifest(manifest)
+            self.assertEqual(default.rule_order[0], 'digits_only')
+            self.assertEqual(default.normalize('311PL', 'G'), (160, 6, True))
+
+    def test_rule_stats_order_independent(self):
+        samples = list(iter_input('../../samples/dodgertest.csv'))[:200]
+        stats = []
+        for adaptive_rules in (False, True):
+            normalizer = Normalizer(adaptive_rules=adaptive_rules)
+            normalizer.read_manifest('../../manifests/dodgerstadium_sections.csv')
+            for sample in samples:
+                normalizer.normalize(sample['input']['section'], sample['input']['row'])
+            stats.append(normalizer.rule_stats)
+            self.assertEqual(normalizer.rule_order[0], 'digits_only')
+        self.assertEqual(stats[0], stats[1])
+
+    def test_renormalize_results(self):
+        old = Normalizer()
+        old.read_manifest('../../manifests/citifield_sections.csv')
+        input = '../../samples/metstest.csv'
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            previous = os.path.join(tmp_dir, 'previous.jsonl')
+            with open(previous, 'w') as f:
+                for match in normalize_file(old, input):
+                    f.write(json.dumps(match) + '\n')
+
+            manifest = os.path.join(tmp_dir, 'citifield_sections.csv')
+            with open('../../manifests/citifield_sections.csv', 'r') as f_in, open(manifest, 'w') as f_out:
+                for line in f_in:
+                    if not line.startswith('1,133,'):
+                        f_out.write(line.replace(',425,', ',Promenade 425,'))
+
+            new = Normalizer()
+            new.read_manifest(manifest)
+            changes = new.diff_manifest(old)
+            self.assertEqual(changes['sections'], {'133', '425', 'promenade 425'})
+            self.assertEqual(changes['digit_buckets'], {'133', '425'})
+            self.assertIn(('133', 'a'), changes['rows'])
+            self.assertTrue(new.may_change(changes, 'Field Level 133', 'A'))
+            self.assertFalse(new.may_change(changes, 'Field Level 134', 'A'))
+            self.assertFalse(new.may_change(changes, '133', 'A-C'))
+
+            self.assertEqual(list(renormalize_results(new, old, previous)), list(normalize_file(new, input)))
+
     def test_mets(self):
         invalid_matches = get_invalid_matches(
             manifest='../../manifests/citifield_sections.csv',